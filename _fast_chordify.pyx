@@ -0,0 +1,44 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+import numpy as np
+import music21 as m21
+
+
+def chordify_to_arrays(chord_stream, int lookback, label_of):
+    '''
+    Compiled version of the chordify_string loop in Preprocessor.convert_path_to_dict \n
+    Param: chord_stream - A chordified music21 stream, already transposed \n
+    Param: lookback - How much context should be provided to the next prediction \n
+    Param: label_of - Function that names a chord that has been put in closed position \n
+    Returns a tuple containing (data, labels, duration) with the same shapes and dtypes as the python loop
+    '''
+    cdef list chords = list(chord_stream.recurse(classFilter=(m21.chord.Chord,)))
+    cdef Py_ssize_t n = len(chords)
+    cdef Py_ssize_t i, j
+    cdef Py_ssize_t head = 0
+
+    windows = np.empty((n, lookback), dtype=object)
+    labels = np.empty(n, dtype=object)
+    durations = np.empty(n, dtype=np.float32)
+    cdef object[:, ::1] windows_view = windows
+    cdef object[::1] labels_view = labels
+    cdef float[::1] durations_view = durations
+
+    # Ring buffer of the last lookback labels, oldest first starting at head
+    cdef list ring = ["START"] * lookback
+
+    for i in range(n):
+        chord = chords[i]
+        chord.closedPosition(forceOctave=4, inPlace=True)
+        for j in range(lookback):
+            windows_view[i, j] = ring[(head + j) % lookback]
+
+        label = label_of(chord)
+        labels_view[i] = label
+        durations_view[i] = float(chord.duration.quarterLength)
+
+        if lookback > 0:
+            ring[head] = label
+            head = (head + 1) % lookback
+
+    # Filled as objects for cheap stores, then converted to the fixed-width strings the python loop returns
+    return windows.astype(str), labels.astype(str), durations
@@ -2,38 +2,46 @@ import pandas as pd
 from pathlib import Path
 from preprocess import Preprocessor
 
-print("Instantiating Preprocessor…")
-prep = Preprocessor(
-    folder_path=Path("surname_checked_midis"),
-    output_type="chordify_string"
-)
+if __name__ == "__main__":
+    print("Instantiating Preprocessor…")
+    prep = Preprocessor(
+        folder_path=Path("surname_checked_midis"),
+        output_type="chordify_string"
+    )
 
-artist = "Bach"
-print("Collecting files…")
-prep.collect(surname=artist)
-print(f"Collected {len(prep.filepath_array)} files.")
+    artist = "Bach"
+    print("Collecting files…")
+    # Filtering happens inside convert_all so each file is only parsed once
+    prep.collect(surname=artist, apply_filter=False)
+    print(f"Collected {len(prep.filepath_array)} files.")
 
-rows = []
-for path in prep.filepath_array:
-    data, labels, durations = prep.convert_path_to_dict(path)
-    for idx, (inp_ctx, lbl, dur) in enumerate(zip(data, labels, durations)):
-        row = {
-            **{f"lookback_{i+1}": inp_ctx[i] for i in range(prep.lookback)},
-            "label": lbl,
-            "duration": dur,
-            "file": path.name,
-            "position": idx,
-        }
-        rows.append(row)
+    lookback_cols = [[] for _ in range(prep.lookback)]
+    labels_col = []
+    dur_col = []
+    file_col = []
+    pos_col = []
+    for path, data, labels, durations in prep.convert_all():
+        for idx, (inp_ctx, lbl, dur) in enumerate(zip(data, labels, durations)):
+            for j in range(prep.lookback):
+                lookback_cols[j].append(inp_ctx[j])
+            labels_col.append(lbl)
+            dur_col.append(dur)
+            file_col.append(path.name)
+            pos_col.append(idx)
 
-df = pd.DataFrame(rows)
+    # Declaring the dtypes up front skips inference and keeps the strings Arrow backed
+    string_dtype = pd.StringDtype("pyarrow")
+    df = pd.DataFrame({
+        **{f"lookback_{j+1}": pd.array(lookback_cols[j], dtype=string_dtype) for j in range(prep.lookback)},
+        "label": pd.array(labels_col, dtype=string_dtype),
+        "duration": pd.array(dur_col, dtype="float32"),
+        "file": pd.array(file_col, dtype=string_dtype),
+        "position": pd.array(pos_col, dtype="int32"),
+    })
 
-cols = [f"lookback_{i+1}" for i in range(prep.lookback)] + ["label", "duration", "file", "position"]
-df = df[cols]
+    print(df.head())
 
-print(df.head())
-
-output_path = Path("output") / f"{artist}_chord_data.csv"
-output_path.parent.mkdir(exist_ok=True)
-df.to_csv(output_path, index=False)
-print(f"Saved dataframe to {output_path}")
+    output_path = Path("output") / f"{artist}_chord_data.csv"
+    output_path.parent.mkdir(exist_ok=True)
+    df.to_csv(output_path, index=False)
+    print(f"Saved dataframe to {output_path}")
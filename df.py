@@ -1,11 +1,15 @@
 import argparse
+import functools
 from pathlib import Path
-import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from preprocess import Preprocessor
 import argparse
 from contextlib import contextmanager
 import time
 
+_CSV_BUFFER_SIZE = 1 << 20
+
 @contextmanager
 def timer(name):
     t0 = time.perf_counter()
@@ -13,37 +17,81 @@ def timer(name):
     t1 = time.perf_counter()
     print(f"[{name}] {t1-t0:.3f}s")
 
-def extract(prep: Preprocessor, artist: str) -> pd.DataFrame:
+def _columns(lookback: int) -> list[str]:
+    return [f"lookback_{j+1}" for j in range(lookback)] + ["label", "duration", "file", "position"]
+
+@functools.lru_cache(maxsize=None)
+def _csv_field(value) -> str:
+    # Same minimal quoting as csv.writer; file names regularly contain commas.
+    # Cached since the same few chord labels make up almost every field
+    text = str(value)
+    if any(char in text for char in ',"\r\n'):
+        return '"' + text.replace('"', '""') + '"'
+    return text
+
+def _write_csv(results, out_file: Path, lookback: int) -> None:
+    # Rows are encoded into one preallocated buffer that is flushed whenever the next row would not fit
+    buffer = bytearray(_CSV_BUFFER_SIZE)
+    offset = 0
+    with open(out_file, "wb") as f:
+        f.write((",".join(_columns(lookback)) + "\n").encode("utf-8"))
+        for path, data, labels, durations in results:
+            with timer(f"  file {path.name}"):
+                file_field = "," + _csv_field(path.name) + ","
+                rows = zip(data.tolist(), labels.tolist(), durations.astype(str).tolist())
+                for idx, (inp_ctx, lbl, dur) in enumerate(rows):
+                    row = (",".join([*map(_csv_field, inp_ctx), _csv_field(lbl), dur]) + file_field + str(idx) + "\n").encode("utf-8")
+                    if offset + len(row) > len(buffer):
+                        f.write(buffer[:offset])
+                        offset = 0
+                    buffer[offset:offset + len(row)] = row
+                    offset += len(row)
+        f.write(buffer[:offset])
+
+def _write_parquet(results, out_file: Path, lookback: int) -> None:
+    lookback_cols = [[] for _ in range(lookback)]
+    labels_col = []
+    dur_col = []
+    file_col = []
+    pos_col = []
+    for path, data, labels, durations in results:
+        with timer(f"  file {path.name}"):
+            for j in range(lookback):
+                lookback_cols[j].extend(data[:, j].tolist())
+            labels_col.extend(labels.tolist())
+            dur_col.extend(durations.tolist())
+            file_col.extend([path.name] * len(labels))
+            pos_col.extend(range(len(labels)))
+
+    # Chord vocabularies are tiny, so dictionary encoding stores each label once
+    label_cols = lookback_cols + [labels_col]
+    table = pa.table({
+        **{name: pa.array(col).dictionary_encode() for name, col in zip(_columns(lookback), label_cols)},
+        "duration": pa.array(dur_col, pa.float32()),
+        "file": pa.array(file_col).dictionary_encode(),
+        "position": pa.array(pos_col, pa.int32()),
+    })
+    pq.write_table(table, out_file, compression="zstd")
+
+def extract(prep: Preprocessor, artist: str, out_file: Path, output_format: str = "csv") -> None:
     """
-    Run processing for all collected files and return a DataFrame of chord events.
+    Run processing for all collected files and write their chord events to out_file.
+    CSV rows are streamed as each file finishes; Parquet is written once all files are done.
     """
     print(f"Collecting files for artist '{artist}'...")
-    prep.collect(surname=artist)
+    # Filtering happens inside convert_all so each file is only parsed once
+    prep.collect(surname=artist, apply_filter=False)
     print(f"Collected {len(prep.filepath_array)} files.")
 
-    rows = []
+    results = prep.convert_all()
+    write = _write_parquet if output_format == "parquet" else _write_csv
     with timer("all-files loop"):
-        for path in prep.filepath_array:
-            data, labels, durations = prep.convert_path_to_dict(path)
-            with timer(f"  file {path.name}"):
-                for idx, (inp_ctx, lbl, dur) in enumerate(zip(data, labels, durations)):
-                    row = {
-                        **{f"lookback_{i+1}": inp_ctx[i] for i in range(prep.lookback)},
-                        "label": lbl,
-                        "duration": dur,
-                        "file": path.name,
-                        "position": idx,
-                    }
-                    rows.append(row)
-
-    df = pd.DataFrame(rows)
-    cols = [f"lookback_{i+1}" for i in range(prep.lookback)] + ["label", "duration", "file", "position"]
-    return df[cols]
+        write(results, out_file, prep.lookback)
 
 
 def main():
     parser = argparse.ArgumentParser(
-        description="Run the MIDI Preprocessor over a folder or single file and export CSV."
+        description="Run the MIDI Preprocessor over a folder or single file and export CSV or Parquet."
     )
     # Preprocessor __init__ args
     parser.add_argument(
@@ -77,6 +125,10 @@ def main():
         "-r", "--resolution", type=int, default=8,
         help="Sub-divisions per quarter-note (only for pianoroll)"
     )
+    parser.add_argument(
+        "-j", "--num-workers", type=int, default=None,
+        help="Number of processes used to parse files (default: number of CPUs)"
+    )
     parser.add_argument(
         "--output-type", choices=["chordify_string", "chordify_int", "pianoroll"],
         default="chordify_string", help="Format of processed output"
@@ -99,7 +151,11 @@ def main():
     # output directory
     parser.add_argument(
         "-o", "--output-dir", type=Path, default=Path("output"),
-        help="Directory to save CSV files (default: ./output)"
+        help="Directory to save output files (default: ./output)"
+    )
+    parser.add_argument(
+        "--format", dest="output_format", choices=["csv", "parquet"], default="csv",
+        help="File format of the saved chord events (default: csv)"
     )
     args = parser.parse_args()
 
@@ -110,27 +166,26 @@ def main():
         binarize=args.binarize,
         lookback=args.lookback,
         resolution=args.resolution,
-        output_type=args.output_type
+        output_type=args.output_type,
+        num_workers=args.num_workers
     )
 
     args.output_dir.mkdir(parents=True, exist_ok=True)
 
     if args.midi_path:
-        # Single-file CSV
+        # Single file
         artist_name = args.surname or args.midi_path.stem
         output_method = args.output_type
-        df = extract(prep, artist=artist_name)
-        out_file = args.output_dir / f"{artist_name}_{output_method}_data.csv"
-        df.to_csv(out_file, index=False)
-        print(f"Saved dataframe to {out_file}")
+        out_file = args.output_dir / f"{artist_name}_{output_method}_data.{args.output_format}"
+        extract(prep, artist=artist_name, out_file=out_file, output_format=args.output_format)
+        print(f"Saved chord events to {out_file}")
     else:
         # Folder of files
         artist_name = args.surname or "all"
         output_method = args.output_type
-        df = extract(prep, artist=artist_name)
-        out_file = args.output_dir / f"{artist_name}_{output_method}_data.csv"
-        df.to_csv(out_file, index=False)
-        print(f"Saved dataframe to {out_file}")
+        out_file = args.output_dir / f"{artist_name}_{output_method}_data.{args.output_format}"
+        extract(prep, artist=artist_name, out_file=out_file, output_format=args.output_format)
+        print(f"Saved chord events to {out_file}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,5 +1,8 @@
+import csv
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import numpy as np
+import pandas as pd
 from typing import List, Literal, Tuple, Union
 
 input_type_literal = Literal["chordify_string","chordify_int", "chordify_roman", "pianoroll", "full_pianoroll"]
@@ -13,24 +16,29 @@ class Postprocessor():
         if type(path) == str:
             path = Path(path)
 
-        with open(path, "r") as f:
-            lines = f.readlines()
+        # Parsed by the C engine; quoting is off and every value is kept as a string, as written.
+        # Blank lines are kept and an empty label is the only NA value, so lines without a label can be rejected
+        try:
+            lines = pd.read_csv(path, sep="|", header=None, usecols=[0, 1], dtype=str, engine="c",
+                                quoting=csv.QUOTE_NONE, keep_default_na=False, na_values={1: [""]},
+                                skip_blank_lines=False)
+        except pd.errors.EmptyDataError:
+            return np.empty((0, 2), dtype=str)
 
-        val = []
-        for line in lines:
-            line = line.split("|")
-            val.append((line[0].strip(), line[1].strip()))
+        missing = lines[1].isna()
+        if missing.any():
+            raise ValueError(f"Line {missing.idxmax() + 1} of {path} is missing its '|' separated label")
 
-        return np.array(val)
+        return np.char.strip(lines.to_numpy().astype(str))
 
-    def from_folder(self, path: Union[str | Path]) -> np.ndarray[np.ndarray[Tuple[str, str]]]:
+    def from_folder(self, path: Union[str | Path]) -> np.ndarray[Tuple[str, str]]:
         if type(path) == str:
             path = Path(path)
 
-        val = []
-        for output in path.glob("**/*.txt"):
-            val.append(self.from_file(output))
-
-        return np.array(val)
-        
+        paths = list(path.glob("**/*.txt"))
+        if len(paths) <= 0:
+            return np.empty((0, 2), dtype=str)
 
+        # Reading is mostly IO bound, so threads are enough
+        with ThreadPoolExecutor() as executor:
+            return np.concatenate(list(executor.map(self.from_file, paths)))
@@ -1,21 +1,118 @@
-import contextlib
+import functools
+import operator
+import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from typing import Literal, Union
 import numpy as np
 import music21 as m21
+from numba import njit
 import pypianoroll
-import tempfile
-import shutil
+
+try:
+    # Optional compiled chordify_string loop, built with python setup.py build_ext --inplace
+    from _fast_chordify import chordify_to_arrays
+except ImportError:
+    chordify_to_arrays = None
 
 output_type_literal = Literal["chordify_string","chordify_int", "chordify_roman", "pianoroll", "full_pianoroll"]
 
-@contextlib.contextmanager
-def make_temp():
-    temp_dir = tempfile.mkdtemp()
-    try:
-        yield temp_dir
-    finally:
-        shutil.rmtree(temp_dir)
+# Every piece is transposed to C major, so these are shared rather than rebuilt per file
+_KEY_C = m21.key.Key("C")
+_PITCH_C = m21.pitch.Pitch("C")
+
+# Chord vocabularies are small, so names and numerals are computed once per distinct set of spelled pitches
+_name_cache: dict[tuple[str, ...], str] = {}
+_rn_cache: dict[tuple[str, ...], str] = {}
+
+@functools.lru_cache(maxsize=None)
+def _interval_to_c(tonic_name: str) -> m21.interval.Interval:
+    # One interval per tonic spelling, shared by every file in that key
+    return m21.interval.Interval(m21.pitch.Pitch(tonic_name), _PITCH_C)
+
+def _pitched_common_name(chord: m21.chord.Chord) -> str:
+    key = tuple(sorted(p.nameWithOctave for p in chord.pitches))
+    name = _name_cache.get(key)
+    if name is None:
+        name = _name_cache[key] = chord.pitchedCommonName
+    return name
+
+def _roman_numeral(chord: m21.chord.Chord) -> str:
+    # Keyed on the full voicing, as inversion figures depend on more than the bass and pitch classes
+    key = tuple(sorted(p.nameWithOctave for p in chord.pitches))
+    numeral = _rn_cache.get(key)
+    if numeral is None:
+        numeral = _rn_cache[key] = str(m21.roman.romanNumeralFromChord(chord, _KEY_C).romanNumeral)
+    return numeral
+
+@njit(cache=True)
+def _encode_and_window(midis: np.ndarray, offsets: np.ndarray, lookback: int) -> tuple[np.ndarray, np.ndarray]:
+    # Compiled equivalent of chord_to_base_n followed by sliding_window with 0 padding.
+    # Chord i is made of midis[offsets[i]:offsets[i + 1]]; closed chords fit well within 64 bits
+    n = len(offsets) - 1
+    labels = np.zeros(n, dtype=np.int64)
+    for i in range(n):
+        code = 0
+        for k in range(offsets[i], offsets[i + 1]):
+            code |= 1 << max(midis[k] - 60, 0)
+        labels[i] = code
+
+    windows = np.zeros((n, lookback), dtype=np.int64)
+    for i in range(n):
+        for j in range(lookback):
+            source = i - lookback + j
+            if source >= 0:
+                windows[i, j] = labels[source]
+
+    return labels, windows
+
+def _scan_midis(folder: Union[Path, str], surname: str = None):
+    # Names are checked on the raw directory entries so rejected files never become Path objects.
+    # normcase keeps the suffix and surname match case-insensitive on Windows, like glob and Path.match were
+    prefix = None if surname is None else os.path.normcase(surname)
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            # Directory symlinks are not followed, so a link cycle cannot recurse forever
+            if entry.is_dir(follow_symlinks=False):
+                yield from _scan_midis(entry.path, surname)
+                continue
+
+            name = os.path.normcase(entry.name)
+            if name.endswith(".mid") and (prefix is None or name.startswith(prefix)):
+                yield Path(entry.path)
+
+def _is_valid(music_data: m21.stream.Score, key: m21.key.Key) -> bool:
+    # Filter if not major
+    if key.mode != "major":
+        return False
+
+    # Filter if more than one time signature
+    if len(music_data.getTimeSignatures()) > 1:
+        return False
+
+    return True
+
+_worker_prep: "Preprocessor" = None
+
+def _init_worker(prep: "Preprocessor"):
+    global _worker_prep
+    _worker_prep = prep
+
+def _worker(path: Path):
+    '''
+    Parses, filters and converts a single file, so each file is parsed and key analyzed only once.
+    Only the resulting arrays are sent back from worker processes, never the stream
+    '''
+    music_data = m21.converter.parse(path)
+    key = music_data.analyze("key")
+    if not _is_valid(music_data, key):
+        return None
+
+    result = _worker_prep.convert_path_to_dict(path, stream=music_data, key=key)
+    if result is None:
+        return None
+    data, labels, durations = result
+    return path, data, labels, durations
 
 class Preprocessor():
 
@@ -24,14 +121,16 @@ class Preprocessor():
                  binarize:bool=True,
                  lookback:int=1,
                  resolution:int=8,
-                 output_type:output_type_literal = "chordify_string"):
+                 output_type:output_type_literal = "chordify_string",
+                 num_workers:int = None):
         '''
         Creates a preprocessor object that allows for easy access of piano rolls \n
         Param: get_dict - Returns a dictionary form similar to that of Markov Chains where the key is the length of lookback \n
         Param: binarize - Returns a binarized form of the piano roll \n
         Param: lookback - How much context should be provided to the next prediction \n
         Param: resolution - How often should the the loader sample within the music between quarter notes \n
-        Param: output_type - Select what kind of output is generated from the preprocessor
+        Param: output_type - Select what kind of output is generated from the preprocessor \n
+        Param: num_workers - How many processes are used to parse files; defaults to the number of CPUs
         '''
         if type(folder_path) == str:
             folder_path = Path(folder_path)
@@ -43,24 +142,30 @@ class Preprocessor():
         self.resolution = resolution
         self.filepath_array = []
         self.output_type = output_type
+        self.num_workers = num_workers or os.cpu_count()
+        self._stream_cache: dict[Path, tuple[m21.stream.Score, m21.key.Key]] = {}
+
+    def __getstate__(self):
+        # Parsed streams never leave this process; workers parse their own files
+        state = self.__dict__.copy()
+        state["_stream_cache"] = {}
+        return state
 
-    def collect(self, surname:str=None):
+    def collect(self, surname:str=None, apply_filter:bool=True):
         '''
         Grabs all file paths that match the surname provided \n
-        Param: surname - returns all midi files whos title contains the surname
+        Param: surname - returns all midi files whos title contains the surname \n
+        Param: apply_filter - Filters out non-valid songs in this process, keeping each valid stream until it is converted;
+        turn off when the paths are only passed to convert_all, which filters in parallel as it converts
         '''
         if not self.folder_path.is_dir():
             raise FileNotFoundError("Specificed folder path does not exist")
         
-        files = self.folder_path.glob("**/*.mid")
-        if surname is None:
-            filepath_array = list(files)
-        else:
-            filepath_array = [filepath for filepath in files if filepath.match(f"{surname}*.mid")]
-            if len(filepath_array) <= 0:
-                raise FileNotFoundError("No valid files were found containing the specificed surname. Check your spelling")
+        filepath_array = list(_scan_midis(self.folder_path, surname))
+        if surname is not None and len(filepath_array) <= 0:
+            raise FileNotFoundError("No valid files were found containing the specificed surname. Check your spelling")
 
-        self.filepath_array = self.filter(filepath_array)
+        self.filepath_array = self.filter(filepath_array) if apply_filter else filepath_array
 
     def filter(self, filepath_array: list[Path]) -> list[Path]:
         '''
@@ -68,20 +173,47 @@ class Preprocessor():
         Param: filepath_array - A List object of paths of midi files\n
         Returns a filtered list of paths
         '''
-        filtered_filepath_array = []
+        filtered = []
         for path in filepath_array:
             music_data = m21.converter.parse(path)
-            # Filter if not major
-            if music_data.analyze("key").mode != "major":
-                continue
+            key = music_data.analyze("key")
+            if _is_valid(music_data, key):
+                # Kept so convert_path_to_dict and convert_all reuse the stream and key instead of parsing again
+                self._stream_cache[path] = (music_data, key)
+                filtered.append(path)
 
-            # Filter if more than one time signature
-            if len(music_data.getTimeSignatures()) > 1:
-                continue
+        return filtered
 
-            filtered_filepath_array.append(path)
+    def convert_all(self):
+        '''
+        Parses, filters and converts every collected file, in parallel when num_workers is above one\n
+        Files already parsed by filter() are converted in this process from their kept stream instead\n
+        Yields a tuple containing (path, data, labels, duration) for each file that passes the filter\n
+        Callers must be guarded by if __name__ == "__main__"
+        '''
+        uncached = [path for path in self.filepath_array if path not in self._stream_cache]
+        if self.num_workers == 1 or len(uncached) <= 0:
+            _init_worker(self)
+            yield from self._merge_results(map(_worker, uncached))
+            return
 
-        return filtered_filepath_array
+        with ProcessPoolExecutor(max_workers=self.num_workers,
+                                 initializer=_init_worker, initargs=(self,)) as executor:
+            yield from self._merge_results(executor.map(_worker, uncached, chunksize=4))
+
+    def _merge_results(self, worker_results):
+        # Worker results arrive in the order of the uncached paths, so they are interleaved back in collected order
+        for path in self.filepath_array:
+            if path not in self._stream_cache:
+                result = next(worker_results)
+                if result is not None:
+                    yield result
+                continue
+
+            result = self.convert_path_to_dict(path)
+            if result is not None:
+                data, labels, durations = result
+                yield path, data, labels, durations
 
     def __len__(self):
         return len(self.filepath_array)
@@ -101,91 +233,97 @@ class Preprocessor():
         return self.convert_path_to_dict(self.filepath_array[index])
     
     
-    def convert_path_to_dict(self, path: Path, transpose:bool=True) -> tuple[np.ndarray, Union[np.ndarray, None], Union[np.ndarray, None]]:
+    def convert_path_to_dict(self, path: Path, transpose:bool=True,
+                             stream:m21.stream.Stream=None,
+                             key:m21.key.Key=None) -> tuple[np.ndarray, Union[np.ndarray, None], Union[np.ndarray, None]]:
         '''
         Internal function to help convert piano rolls and m21 streams into sliding window
         representations that can be used as training data. \n
         Param: path - Path object to the midi file to convert \n
         Param: transpose - Bool on whether or not to transpose the piece to C Major; should generally always be true\n
+        Param: stream - An already parsed stream of the file; it may be modified in place \n
+        Param: key - The already analyzed key of the stream \n
         Returns a tuple containing (data, labels if applicable, duration if applicable)
         '''
-        music_data = m21.converter.parse(path)
-        key = music_data.analyze("key")
+        if stream is None and path in self._stream_cache:
+            # Popped so each stream is only held until its file is converted
+            music_data, key = self._stream_cache.pop(path)
+        elif stream is None:
+            music_data = m21.converter.parse(path)
+            key = music_data.analyze("key")
+        else:
+            music_data = stream
+            if key is None:
+                key = music_data.analyze("key")
 
-        if transpose and key != m21.key.Key("C"):
-            i = m21.interval.Interval(key.tonic, m21.pitch.Pitch("C"))
+        num_semitones = 0
+        if transpose and key.tonic.name != "C":
+            i = _interval_to_c(key.tonic.name)
             num_semitones = i.semitones
             music_data.transpose(i, inPlace=True)
 
         if self.output_type == "chordify_string":
-            data = []
+            chord_data = music_data.chordify()
+            if chordify_to_arrays is not None:
+                return chordify_to_arrays(chord_data, self.lookback, _pitched_common_name)
+
             labels = []
             duration = []
-            moving_window = ["START"] * self.lookback
-            chord_data = music_data.chordify()
-            for chord in chord_data.recurse().getElementsByClass(m21.chord.Chord):
+            for chord in chord_data.recurse(classFilter=(m21.chord.Chord,)):
                 chord.closedPosition(forceOctave=4, inPlace=True)
-                data.append(moving_window.copy())
-                labels.append(chord.pitchedCommonName)
-                duration.append(chord.duration.quarterLength)
+                labels.append(_pitched_common_name(chord))
+                duration.append(float(chord.duration.quarterLength))
 
-                moving_window.pop(0)
-                moving_window.append(chord.pitchedCommonName)
-            
-            return np.array(data), np.array(labels), np.array(duration)
+            return self.sliding_window(labels, "START"), np.array(labels), np.asarray(duration, dtype=np.float32)
         
         elif self.output_type == "chordify_int":
-            data = []
-            labels = []
+            midis = []
+            offsets = [0]
             duration = []
-            moving_window = [0] * self.lookback
             chord_data = music_data.chordify()
-            for chord in chord_data.recurse().getElementsByClass(m21.chord.Chord):
+            for chord in chord_data.recurse(classFilter=(m21.chord.Chord,)):
                 chord.closedPosition(forceOctave=4, inPlace=True)
-                data.append(moving_window.copy())
-                chord_as_int = self.chord_to_base_n(chord)
-                labels.append(chord_as_int)
-                duration.append(chord.duration.quarterLength)
-
-                moving_window.pop(0)
-                moving_window.append(chord_as_int)
+                midis.extend(pitch.midi for pitch in chord.pitches)
+                offsets.append(len(midis))
+                duration.append(float(chord.duration.quarterLength))
 
-            return np.array(data), np.array(labels), np.array(duration)
+            labels, data = _encode_and_window(np.asarray(midis, dtype=np.int64),
+                                              np.asarray(offsets, dtype=np.int64),
+                                              self.lookback)
+            return data, labels, np.asarray(duration, dtype=np.float32)
         
         elif self.output_type == "chordify_roman":
-            data = []
             labels = []
             duration = []
-            moving_window = ["START"] * self.lookback
             chord_data = music_data.chordify()
-            for chord in chord_data.recurse().getElementsByClass(m21.chord.Chord):
-                chord_rn = str(m21.roman.romanNumeralFromChord(chord, m21.key.Key("C")).romanNumeral)
-                chord.closedPosition(forceOctave=4, inPlace=True)
-                data.append(moving_window.copy())
-                labels.append(chord_rn)
-                duration.append(chord.duration.quarterLength)
+            for chord in chord_data.recurse(classFilter=(m21.chord.Chord,)):
+                # Closed position is not needed here since only the numeral is kept
+                labels.append(_roman_numeral(chord))
+                duration.append(float(chord.duration.quarterLength))
 
-                moving_window.pop(0)
-                moving_window.append(chord_rn)
-            
-            return np.array(data), np.array(labels), np.array(duration)
+            return self.sliding_window(labels, "START"), np.array(labels), np.asarray(duration, dtype=np.float32)
 
         
         # When piano roll, the lookback is forced to be 1 to decrease complexity
         elif self.output_type == "pianoroll":
-            with make_temp() as temp_dir:
-                output_path = music_data.write("midi", fp=Path(temp_dir, "temp.mid"))
-                roll = pypianoroll.read(output_path).set_resolution(self.resolution)
-
-            if len(roll.tracks) > 1:
+            if len(music_data.parts) > 1:
                 print(f"The song {path.name} has more than one track. Exiting...")
                 return
-            
-            roll = roll.tracks[0]
-            if self.binarize:
-                roll = roll.binarize()
-            
-            roll = roll.pianoroll.astype(float)
+
+            # Rasterized straight from the stream rather than round-tripping through a midi file
+            notes = []
+            for note in music_data.flatten().notes:
+                start = round(note.offset * self.resolution)
+                end = round((note.offset + note.duration.quarterLength) * self.resolution)
+                # Same velocity music21 would have written to the midi file
+                velocity = 1 if self.binarize else round(note.volume.cachedRealized * 127)
+                notes.extend((start, end, velocity, pitch.midi) for pitch in note.pitches)
+
+            roll = np.zeros((max((end for _, end, _, _ in notes), default=0), 128), dtype=np.uint8)
+            for start, end, velocity, midi in notes:
+                roll[start:end, midi] = velocity
+
+            roll = roll.astype(float)
             inputs = np.vstack([np.zeros(128), roll[:-1]])
             
             return inputs, roll, None
@@ -205,10 +343,17 @@ class Preprocessor():
 
             return inputs, full_roll, None
 
-    def chord_to_base_n(self, chord: tuple[m21.note.Note, ...]):
-        base_n_sum = 0
-        for note in chord:
-            relative_to_c4 = note.pitch.midi - 60
-            base_n_sum += 2 ** relative_to_c4
+    def sliding_window(self, labels: list, pad) -> np.ndarray:
+        '''
+        Builds the lookback context that precedes every label \n
+        Param: labels - The sequence of labels of a song \n
+        Param: pad - The value used for context from before the song starts \n
+        Returns an array of shape (len(labels), lookback) where row i holds the lookback labels before label i
+        '''
+        sequence = np.array([pad] * self.lookback + labels)
+        # Copied out of the strided view so callers get a writable array, like the other output types
+        return np.ascontiguousarray(np.lib.stride_tricks.sliding_window_view(sequence, window_shape=self.lookback)[:-1])
 
-        return base_n_sum
\ No newline at end of file
+    def chord_to_base_n(self, chord: tuple[m21.note.Note, ...]):
+        # One bit per semitone above C4; notes below C4 are clamped onto it
+        return functools.reduce(operator.or_, (1 << max(note.pitch.midi - 60, 0) for note in chord), 0)
@@ -0,0 +1,11 @@
+import numpy as np
+from Cython.Build import cythonize
+from setuptools import Extension, setup
+
+# Builds the optional compiled chordify loop used by preprocess.py:
+#   python setup.py build_ext --inplace
+setup(
+    ext_modules=cythonize(
+        [Extension("_fast_chordify", ["_fast_chordify.pyx"], include_dirs=[np.get_include()])]
+    ),
+)